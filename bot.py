@@ -1,24 +1,30 @@
 import os
+import asyncio
 import sqlite3
-import json
 import random
 import logging
-from datetime import datetime, timedelta, time as dtime
-from typing import Optional, Tuple, List, Dict
-
-import pytz
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from types import MappingProxyType
+from datetime import date, datetime, timedelta, time as dtime
+from typing import Optional, Tuple, List, Dict, Mapping
+from zoneinfo import ZoneInfo
+
+import orjson
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder, ContextTypes, CommandHandler,
-    MessageHandler, CallbackQueryHandler, filters, PicklePersistence
+    MessageHandler, CallbackQueryHandler, filters
 )
 
 # ---------- Config ----------
 load_dotenv()
 TOKEN = os.getenv("TOKEN")
 TZNAME = os.getenv("TZ", "Europe/Madrid")
-TZ = pytz.timezone(TZNAME)
+TZ = ZoneInfo(TZNAME)
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
@@ -33,6 +39,11 @@ DB_PATH = "trivia.db"
 QUESTION_WINDOW_SECONDS = 180
 DAILY_TIMES = ["10:00", "12:00", "14:00", "16:00", "18:00", "20:00"]
 SUMMARY_TIME = "21:00"
+# Envíos simultáneos por ronda; Telegram limita los mensajes masivos (~30/s).
+MAX_CONCURRENT_SENDS = 10
+
+# Generador propio: no compartimos el estado del módulo random con otros usos.
+_RNG = random.Random(os.urandom(16))
 
 PHRASE_START = [
     "🎯 *Instructor GUN4FUN:* ¡Hora de afinar puntería!",
@@ -59,26 +70,59 @@ BADGES = [
     {"code":"RACHA_3","name":"Racha x3","desc":"3 aciertos seguidos","type":"streak"},
     {"code":"RACHA_5","name":"Racha x5","desc":"5 aciertos seguidos","type":"streak"},
 ]
+BADGES_BY_CODE = {b["code"]: b for b in BADGES}
 
 # ---------- Data ----------
 def load_questions(path="questions_lightgun_es.json"):
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(path, "rb") as f:
+        data = orjson.loads(f.read())
     cleaned = [q for q in data if "q" in q and "choices" in q and "answer" in q and q["answer"] in q["choices"]]
     if not cleaned:
         raise RuntimeError("No se cargaron preguntas válidas del JSON.")
-    return cleaned
+    # Las preguntas no cambian tras cargarse: precalculamos lo que usa trivia_job
+    # y las congelamos.
+    for q in cleaned:
+        q["choices_tuple"] = tuple(q["choices"])
+        q["choices_json"] = orjson.dumps(q["choices"]).decode()
+    return tuple(MappingProxyType(q) for q in cleaned)
 
 QUESTIONS = load_questions()
 
 # ---------- DB ----------
+_CONN: Optional[sqlite3.Connection] = None
+_DB_LOCK = threading.RLock()
+
 def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return _CONN
+
+@contextmanager
+def tx(write: bool = True):
+    # Conexión única compartida: serializamos el acceso y, si hay escritura,
+    # la envolvemos en BEGIN IMMEDIATE/COMMIT (la conexión va en autocommit).
+    with _DB_LOCK:
+        c = db()
+        if not write:
+            yield c
+            return
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            yield c
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
 
 def ensure_db():
-    with db() as c:
+    global _CONN
+    if _CONN is None:
+        _CONN = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        _CONN.row_factory = sqlite3.Row
+        _CONN.execute("PRAGMA journal_mode=WAL")
+        _CONN.execute("PRAGMA synchronous=NORMAL")
+        _CONN.execute("PRAGMA temp_store=MEMORY")
+        _CONN.execute("PRAGMA mmap_size=268435456")
+        _CONN.execute("PRAGMA cache_size=-20000")
+    with tx() as c:
         c.execute("""
         CREATE TABLE IF NOT EXISTS users(
             chat_id INTEGER,
@@ -130,10 +174,35 @@ def ensure_db():
             PRIMARY KEY(chat_id, user_id, code, period_key)
         );
         """)
-        c.commit()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS chats(
+            chat_id INTEGER PRIMARY KEY
+        );
+        """)
+        # answers(event_id) ya lo cubre el prefijo de su PRIMARY KEY.
+        indexes = {
+            "idx_events_chat_start": "events(chat_id, start_ts)",
+            "idx_answers_event_correct": "answers(event_id, user_id, correct)",
+            "idx_users_chat_seen": "users(chat_id, last_seen_ts)",
+        }
+        existing = {r["name"] for r in c.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        for name, target in indexes.items():
+            c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+        # Estadísticas para el planificador solo cuando se acaba de crear algún índice.
+        if not existing.issuperset(indexes):
+            c.execute("ANALYZE")
+
+def load_chat_ids() -> set:
+    with tx(write=False) as c:
+        return {r["chat_id"] for r in c.execute("SELECT chat_id FROM chats")}
+
+def _add_chat(chat_id: int):
+    with tx() as c:
+        c.execute("INSERT OR IGNORE INTO chats(chat_id) VALUES(?)", (chat_id,))
 
 def now_ts() -> int:
-    return int(datetime.now(tz=TZ).timestamp())
+    # Un timestamp Unix no depende de la zona horaria.
+    return int(time.time())
 
 def parse_hhmm(s: str) -> Optional[Tuple[int,int]]:
     try:
@@ -149,6 +218,23 @@ def local_time(hh: int, mm: int) -> dtime:
     return dtime(hour=hh, minute=mm, tzinfo=TZ)
 
 # ---------- Bot logic ----------
+def _upsert_user(c: sqlite3.Connection, chat_id: int, user_id: int, name: str, ts: int):
+    c.execute("""
+    INSERT INTO users(chat_id, user_id, name, last_seen_ts)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+    name=excluded.name, last_seen_ts=excluded.last_seen_ts
+    """, (chat_id, user_id, name, ts))
+    c.execute("""
+    INSERT INTO streaks(chat_id, user_id, streak, best_streak)
+    VALUES(?, ?, 0, 0)
+    ON CONFLICT(chat_id, user_id) DO NOTHING
+    """, (chat_id, user_id))
+
+def _touch_user(chat_id: int, user_id: int, name: str, ts: int):
+    with tx() as c:
+        _upsert_user(c, chat_id, user_id, name, ts)
+
 async def touch_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_user or not update.effective_chat:
         return
@@ -156,19 +242,7 @@ async def touch_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     u = update.effective_user
     ch = update.effective_chat
-    with db() as c:
-        c.execute("""
-        INSERT INTO users(chat_id, user_id, name, last_seen_ts)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(chat_id, user_id) DO UPDATE SET
-        name=excluded.name, last_seen_ts=excluded.last_seen_ts
-        """, (ch.id, u.id, u.full_name, now_ts()))
-        c.execute("""
-        INSERT INTO streaks(chat_id, user_id, streak, best_streak)
-        VALUES(?, ?, 0, 0)
-        ON CONFLICT(chat_id, user_id) DO NOTHING
-        """, (ch.id, u.id))
-        c.commit()
+    await asyncio.to_thread(_touch_user, ch.id, u.id, u.full_name, now_ts())
 
 async def schedule_jobs(app):
     for idx, hhmm in enumerate(DAILY_TIMES):
@@ -177,75 +251,109 @@ async def schedule_jobs(app):
     hh, mm = parse_hhmm(SUMMARY_TIME)
     app.job_queue.run_daily(daily_summary_job, time=local_time(hh, mm), name="daily_summary")
 
-def pick_question() -> dict:
-    return random.choice(QUESTIONS)
-
-async def trivia_job(context: ContextTypes.DEFAULT_TYPE):
-    chat_ids = getattr(context.application.bot_data, "chat_ids", set())
+def pick_question() -> Mapping:
+    return _RNG.choice(QUESTIONS)
+
+def _insert_events(chat_ids: List[int], q: Mapping, start: int, end: int) -> List[Tuple[int,int]]:
+    # Un único INSERT multi-fila; RETURNING (SQLite >= 3.35) devuelve los ids
+    # sin orden garantizado, por eso se devuelve también el chat_id.
+    values = ",".join(["(?, ?, ?, ?, ?, ?)"] * len(chat_ids))
+    params = [v for chat_id in chat_ids
+              for v in (chat_id, q["q"], q["choices_json"], q["answer"], start, end)]
+    with tx() as c:
+        return [tuple(r) for r in c.execute(f"""
+            INSERT INTO events(chat_id, question, choices, answer, start_ts, end_ts)
+            VALUES {values}
+            RETURNING chat_id, id
+        """, params).fetchall()]
+
+def _delete_events(event_ids: List[int]):
+    with tx() as c:
+        c.executemany("DELETE FROM events WHERE id=?", [(eid,) for eid in event_ids])
+
+async def send_round(context: ContextTypes.DEFAULT_TYPE, chat_ids: List[int]):
     if not chat_ids:
         return
-    for chat_id in chat_ids:
-        q = pick_question()
-        start = now_ts()
-        end = start + QUESTION_WINDOW_SECONDS
-        with db() as c:
-            c.execute("""
-                INSERT INTO events(chat_id, question, choices, answer, start_ts, end_ts)
-                VALUES(?, ?, ?, ?, ?, ?)
-            """, (chat_id, q["q"], "|".join(q["choices"]), q["answer"], start, end))
-            event_id = c.lastrowid
-            c.commit()
+    # Misma pregunta y mismo texto para todos los chats de esta ronda;
+    # solo el callback_data (event_id) cambia por chat.
+    q = pick_question()
+    msg = (
+        f"{_RNG.choice(PHRASE_START)}\n\n"
+        "🎯 *TRIVIA LIGHT-GUN*\n\n"
+        f"{q['q']}\n\n"
+        f"⏱️ Tienes {QUESTION_WINDOW_SECONDS//60} min.\n"
+        f"{_RNG.choice(PHRASE_ENCOURAGE)}"
+    )
+    start = now_ts()
+    end = start + QUESTION_WINDOW_SECONDS
+    events = await asyncio.to_thread(_insert_events, chat_ids, q, start, end)
 
+    sem = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+
+    async def _fire(chat_id: int, event_id: int):
         buttons = [[InlineKeyboardButton(opt, callback_data=f"ans|{event_id}|{opt}")]
-                   for opt in q["choices"]]
-        msg = (
-            f"{random.choice(PHRASE_START)}\n\n"
-            "🎯 *TRIVIA LIGHT-GUN*\n\n"
-            f"{q['q']}\n\n"
-            f"⏱️ Tienes {QUESTION_WINDOW_SECONDS//60} min.\n"
-            f"{random.choice(PHRASE_ENCOURAGE)}"
-        )
-        await context.bot.send_message(
-            chat_id,
-            text=msg,
-            reply_markup=InlineKeyboardMarkup(buttons),
-            parse_mode="Markdown"
-        )
+                   for opt in q["choices_tuple"]]
+        async with sem:
+            await context.bot.send_message(
+                chat_id,
+                text=msg,
+                reply_markup=InlineKeyboardMarkup(buttons),
+                parse_mode="Markdown"
+            )
         context.job_queue.run_once(close_event_job, when=QUESTION_WINDOW_SECONDS, data={"event_id": event_id}, chat_id=chat_id)
 
-async def close_event_job(context: ContextTypes.DEFAULT_TYPE):
-    data = context.job.data or {}
-    event_id = data.get("event_id")
-    if not event_id:
-        return
+    results = await asyncio.gather(*(_fire(cid, eid) for cid, eid in events), return_exceptions=True)
+    failed = []
+    for (chat_id, event_id), res in zip(events, results):
+        if isinstance(res, Exception):
+            log.warning("No se pudo enviar la pregunta al chat %s: %s", chat_id, res)
+            failed.append(event_id)
+    # Sin mensaje no hay pregunta: que no quede un evento sin cierre en el ranking.
+    if failed:
+        await asyncio.to_thread(_delete_events, failed)
 
-    with db() as c:
+async def trivia_job(context: ContextTypes.DEFAULT_TYPE):
+    await send_round(context, list(context.application.bot_data.get("chat_ids", ())))
+
+def _close_event(event_id: int):
+    with tx() as c:
         ev = c.execute("SELECT * FROM events WHERE id=?", (event_id,)).fetchone()
         if not ev:
-            return
+            return None
         ans = c.execute("""
             SELECT a.*, u.name FROM answers a
             LEFT JOIN users u ON u.chat_id=? AND u.user_id=a.user_id
             WHERE a.event_id=?
         """, (ev["chat_id"], event_id)).fetchall()
 
-        # update streaks
-        for r in ans:
-            ok = 1 if r["correct"] == 1 else 0
-            row = c.execute("SELECT streak, best_streak FROM streaks WHERE chat_id=? AND user_id=?", (ev["chat_id"], r["user_id"])).fetchone()
-            if not row:
-                c.execute("INSERT INTO streaks(chat_id, user_id, streak, best_streak) VALUES(?,?,0,0)", (ev["chat_id"], r["user_id"]))
-                row = {"streak":0, "best_streak":0}
-            streak = (row["streak"] + 1) if ok else 0
-            best = max(row["best_streak"], streak)
-            c.execute("UPDATE streaks SET streak=?, best_streak=? WHERE chat_id=? AND user_id=?", (streak, best, ev["chat_id"], r["user_id"]))
-        c.commit()
+        # update streaks (una sola sentencia para todas las respuestas)
+        c.execute("""
+            INSERT INTO streaks(chat_id, user_id, streak, best_streak)
+            SELECT ?, user_id, correct=1, correct=1 FROM answers WHERE event_id=?
+            ON CONFLICT(chat_id, user_id) DO UPDATE SET
+            streak = CASE WHEN excluded.streak=1 THEN streaks.streak+1 ELSE 0 END,
+            best_streak = MAX(streaks.best_streak,
+                              CASE WHEN excluded.streak=1 THEN streaks.streak+1 ELSE 0 END)
+        """, (ev["chat_id"], event_id))
 
         cutoff = now_ts() - 30*24*3600
         roster = c.execute("""
             SELECT user_id, name FROM users WHERE chat_id=? AND last_seen_ts>=?
         """, (ev["chat_id"], cutoff)).fetchall()
 
+    return ev, ans, roster
+
+async def close_event_job(context: ContextTypes.DEFAULT_TYPE):
+    data = context.job.data or {}
+    event_id = data.get("event_id")
+    if not event_id:
+        return
+
+    res = await asyncio.to_thread(_close_event, event_id)
+    if not res:
+        return
+    ev, ans, roster = res
+
     answered_ids = {r["user_id"] for r in ans}
     roster_ids = {r["user_id"] for r in roster}
     not_answered_ids = roster_ids - answered_ids
@@ -263,99 +371,93 @@ async def close_event_job(context: ContextTypes.DEFAULT_TYPE):
     )
     await context.bot.send_message(ev["chat_id"], txt, parse_mode="Markdown")
 
+def _record_answer(event_id: int, user_id: int, name: str, choice: str, now: int) -> str:
+    with tx() as c:
+        ev = c.execute("SELECT * FROM events WHERE id=?", (event_id,)).fetchone()
+        if not ev:
+            return "Evento no encontrado."
+        if now > ev["end_ts"]:
+            return "⏱️ Fuera de tiempo."
+
+        _upsert_user(c, ev["chat_id"], user_id, name, now)
+        ok = choice == ev["answer"]
+        try:
+            c.execute("""
+                INSERT INTO answers(event_id, user_id, choice, correct, ts)
+                VALUES(?, ?, ?, ?, ?)
+            """, (event_id, user_id, choice, 1 if ok else 0, now))
+        except sqlite3.IntegrityError:
+            return "Ya respondiste esta pregunta."
+    return "✅ ¡Correcto!" if ok else "❌ Incorrecto"
+
 async def answer_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await q.answer()
     try:
         _, event_id_str, choice = q.data.split("|", 2)
         event_id = int(event_id_str)
     except Exception:
+        await q.answer()
         return
 
-    with db() as c:
-        ev = c.execute("SELECT * FROM events WHERE id=?", (event_id,)).fetchone()
-        if not ev:
-            await q.answer("Evento no encontrado.")
-            return
-        now = now_ts()
-        if now > ev["end_ts"]:
-            await q.answer("⏱️ Fuera de tiempo.")
-            return
+    user = q.from_user
+    reply = await asyncio.to_thread(_record_answer, event_id, user.id, user.full_name, choice, now_ts())
+    await q.answer(reply)
 
-        user = q.from_user
-        c.execute("""
-        INSERT INTO users(chat_id, user_id, name, last_seen_ts)
-        VALUES(?, ?, ?, ?)
-        ON CONFLICT(chat_id, user_id) DO UPDATE SET
-        name=excluded.name, last_seen_ts=excluded.last_seen_ts
-        """, (ev["chat_id"], user.id, user.full_name, now))
-        c.execute("""
-        INSERT INTO streaks(chat_id, user_id, streak, best_streak)
-        VALUES(?, ?, 0, 0)
-        ON CONFLICT(chat_id, user_id) DO NOTHING
-        """, (ev["chat_id"], user.id))
+def today_local() -> date:
+    return datetime.now(TZ).date()
 
-        try:
-            c.execute("""
-                INSERT INTO answers(event_id, user_id, choice, correct, ts)
-                VALUES(?, ?, ?, ?, ?)
-            """, (event_id, user.id, choice, 1 if choice == ev["answer"] else 0, now))
-            c.commit()
-            if choice == ev["answer"]:
-                await q.answer("✅ ¡Correcto!")
-            else:
-                await q.answer("❌ Incorrecto")
-        except sqlite3.IntegrityError:
-            await q.answer("Ya respondiste esta pregunta.")
+def _midnight_ts(d: date) -> int:
+    return int(datetime(d.year, d.month, d.day, tzinfo=TZ).timestamp())
 
-def period_bounds(kind: str) -> Tuple[int,int]:
-    now_local = datetime.now(TZ)
+@lru_cache(maxsize=16)
+def _bounds(kind: str, day: date) -> Tuple[int,int]:
+    # Solo depende del día local: se calcula una vez por (tipo, día) y las
+    # claves rotan a diario, así que la caché no crece.
     if kind == "dia":
-        start = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
+        start = day
         end = start + timedelta(days=1)
     elif kind == "semana":
-        start = (now_local - timedelta(days=now_local.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+        start = day - timedelta(days=day.weekday())
         end = start + timedelta(days=7)
     else:
-        start = now_local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        if start.month == 12:
-            end = start.replace(year=start.year+1, month=1)
-        else:
-            end = start.replace(month=start.month+1)
-    return int(start.timestamp()), int(end.timestamp())
+        start = day.replace(day=1)
+        end = date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return _midnight_ts(start), _midnight_ts(end)
+
+def period_bounds(kind: str) -> Tuple[int,int]:
+    return _bounds(kind, today_local())
+
+def _rank_rows(c: sqlite3.Connection, chat_id: int, t0: int, t1: int) -> List[sqlite3.Row]:
+    return c.execute("""
+        SELECT a.user_id, u.name,
+               SUM(a.correct=1) AS aciertos,
+               SUM(a.correct=0) AS fallos
+        FROM answers a
+        JOIN events e ON e.id=a.event_id
+        LEFT JOIN users u ON u.chat_id=e.chat_id AND u.user_id=a.user_id
+        WHERE e.chat_id=? AND e.start_ts>=? AND e.start_ts<?
+        GROUP BY a.user_id
+        ORDER BY aciertos DESC, fallos ASC
+    """, (chat_id, t0, t1)).fetchall()
 
 def fetch_rank(chat_id: int, kind: str):
     t0, t1 = period_bounds(kind)
-    with db() as c:
-        evs = c.execute(
-            "SELECT id FROM events WHERE chat_id=? AND start_ts>=? AND start_ts<?",
+    with tx(write=False) as c:
+        rows = _rank_rows(c, chat_id, t0, t1)
+        if not rows and not c.execute(
+            "SELECT EXISTS(SELECT 1 FROM events WHERE chat_id=? AND start_ts>=? AND start_ts<?)",
             (chat_id, t0, t1)
-        ).fetchall()
-        if not evs:
+        ).fetchone()[0]:
             return [], [], []
-        ids = tuple(r["id"] for r in evs)
-        q = f"""
-            SELECT a.user_id, u.name,
-                   SUM(CASE WHEN a.correct=1 THEN 1 ELSE 0 END) AS aciertos,
-                   SUM(CASE WHEN a.correct=0 THEN 1 ELSE 0 END) AS fallos
-            FROM answers a
-            LEFT JOIN users u ON u.chat_id=? AND u.user_id=a.user_id
-            WHERE a.event_id IN ({",".join("?"*len(ids))})
-            GROUP BY a.user_id
-            ORDER BY aciertos DESC, fallos ASC
-        """
-        rows = c.execute(q, (chat_id, *ids)).fetchall()
 
         cutoff = now_ts() - 30*24*3600
         roster = c.execute(
             "SELECT user_id, name FROM users WHERE chat_id=? AND last_seen_ts>=?",
             (chat_id, cutoff)
         ).fetchall()
-        answered = {r["user_id"] for r in c.execute(
-            f"SELECT DISTINCT user_id FROM answers WHERE event_id IN ({','.join('?'*len(ids))})", ids
-        ).fetchall()}
-        not_ans = [r for r in roster if r["user_id"] not in answered]
-        return rows, roster, not_ans
+    answered = {r["user_id"] for r in rows}
+    not_ans = [r for r in roster if r["user_id"] not in answered]
+    return rows, roster, not_ans
 
 def fmt_names(items, limit=10) -> str:
     names = [(r["name"] or f"ID {r['user_id']}") for r in items]
@@ -365,61 +467,54 @@ def fmt_names(items, limit=10) -> str:
         return ", ".join(names[:limit]) + f" … (+{len(names)-limit})"
     return ", ".join(names)
 
-def award_daily_badges(chat_id: int) -> Dict[int, List[Dict]]:
-    t0, t1 = period_bounds("dia")
-    today_key = datetime.fromtimestamp(t0, tz=TZ).strftime("%Y-%m-%d")
+def award_daily_badges(chat_id: int, rows: Optional[List[sqlite3.Row]] = None) -> Dict[int, List[Dict]]:
+    # rows: filas de fetch_rank(chat_id, "dia") si ya se calcularon, para no repetir la agregación.
+    today = today_local()
+    today_key = today.isoformat()
+    ts = now_ts()
     awarded: Dict[int, List[Dict]] = {}
-    with db() as c:
-        rows = c.execute(f"""
-            SELECT a.user_id, COALESCE(u.name, 'ID '||a.user_id) AS name,
-                   SUM(CASE WHEN a.correct=1 THEN 1 ELSE 0 END) AS aciertos
-            FROM answers a
-            LEFT JOIN events e ON e.id=a.event_id
-            LEFT JOIN users u ON u.chat_id=e.chat_id AND u.user_id=a.user_id
-            WHERE e.chat_id=? AND e.start_ts>=? AND e.start_ts<?
-            GROUP BY a.user_id
-        """, (chat_id, t0, t1)).fetchall()
-
+    with tx() as c:
+        if rows is None:
+            t0, t1 = _bounds("dia", today)
+            rows = _rank_rows(c, chat_id, t0, t1)
+
+        existing = {(r["user_id"], r["code"]) for r in c.execute(
+            "SELECT user_id, code FROM badges WHERE chat_id=? AND period_key=?", (chat_id, today_key)
+        )}
+        pending = []
         for r in rows:
             uid = r["user_id"]; acc = r["aciertos"] or 0
             for code, th in [("BRONCE_DIA",3),("PLATA_DIA",5),("ORO_DIA",6)]:
                 if acc >= th:
-                    bd = next(b for b in BADGES if b["code"]==code)
-                    try:
-                        c.execute("""
-                        INSERT INTO badges(chat_id, user_id, code, name, ts, period, period_key)
-                        VALUES(?,?,?,?,?,?,?)
-                        """, (chat_id, uid, bd["code"], bd["name"], now_ts(), "dia", today_key))
-                        awarded.setdefault(uid, []).append(bd)
-                    except sqlite3.IntegrityError:
-                        pass
+                    bd = BADGES_BY_CODE[code]
+                    pending.append((chat_id, uid, bd["code"], bd["name"], ts, "dia", today_key))
         # rachas
         streak_rows = c.execute("SELECT user_id, streak, best_streak FROM streaks WHERE chat_id=?", (chat_id,)).fetchall()
         for r in streak_rows:
             uid = r["user_id"]; s = r["streak"] or 0
             for code, th in [("RACHA_3",3),("RACHA_5",5)]:
                 if s >= th:
-                    bd = next(b for b in BADGES if b["code"]==code)
-                    try:
-                        c.execute("""
-                        INSERT INTO badges(chat_id, user_id, code, name, ts, period, period_key)
-                        VALUES(?,?,?,?,?,?,?)
-                        """, (chat_id, uid, bd["code"], bd["name"], now_ts(), "dia", today_key))
-                        awarded.setdefault(uid, []).append(bd)
-                    except sqlite3.IntegrityError:
-                        pass
-        c.commit()
+                    bd = BADGES_BY_CODE[code]
+                    pending.append((chat_id, uid, bd["code"], bd["name"], ts, "dia", today_key))
+
+        pending = [p for p in pending if (p[1], p[2]) not in existing]
+        c.executemany("""
+        INSERT OR IGNORE INTO badges(chat_id, user_id, code, name, ts, period, period_key)
+        VALUES(?,?,?,?,?,?,?)
+        """, pending)
+    for p in pending:
+        awarded.setdefault(p[1], []).append(BADGES_BY_CODE[p[2]])
     return awarded
 
 async def daily_summary_job(context: ContextTypes.DEFAULT_TYPE):
-    chat_ids = getattr(context.application.bot_data, "chat_ids", set())
+    chat_ids = list(context.application.bot_data.get("chat_ids", ()))
     if not chat_ids:
         return
     for chat_id in chat_ids:
-        rows, roster, not_ans = fetch_rank(chat_id, "dia")
+        rows, roster, not_ans = await asyncio.to_thread(fetch_rank, chat_id, "dia")
         if not rows and not roster:
             continue
-        lines = [f"{random.choice(PHRASE_SUMMARY)}", "🏁 *Resumen diario* (ranking del día)"]
+        lines = [f"{_RNG.choice(PHRASE_SUMMARY)}", "🏁 *Resumen diario* (ranking del día)"]
         top5 = rows[:5]
         pos = 1
         for r in top5:
@@ -429,11 +524,12 @@ async def daily_summary_job(context: ContextTypes.DEFAULT_TYPE):
         if top5:
             lines.append("\n🎉 ¡Enhorabuena a los 5 primeros!")
 
-        newly = award_daily_badges(chat_id)
+        newly = await asyncio.to_thread(award_daily_badges, chat_id, rows)
         if newly:
             lines.append("\n🏅 *Medallas/insignias de hoy:*")
+            names_by_uid = {r["user_id"]: (r["name"] or f"ID {r['user_id']}") for r in rows}
             for uid, badges in newly.items():
-                name = next((r["name"] for r in rows if r["user_id"]==uid), f"ID {uid}")
+                name = names_by_uid.get(uid, f"ID {uid}")
                 uniq = {b["name"] for b in badges}
                 lines.append(f"• {name}: " + ", ".join(sorted(uniq)))
 
@@ -447,9 +543,8 @@ async def daily_summary_job(context: ContextTypes.DEFAULT_TYPE):
 # ---------- Commands ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ch = update.effective_chat
-    ids = getattr(context.application.bot_data, "chat_ids", set())
-    ids.add(ch.id)
-    context.application.bot_data["chat_ids"] = ids
+    await asyncio.to_thread(_add_chat, ch.id)
+    context.application.bot_data.setdefault("chat_ids", set()).add(ch.id)
     await update.message.reply_text(
         "🎯 GUN4FUN Trivia Light-Gun\n\n"
         "Lanzamos 6 preguntas al día (10:00, 12:00, 14:00, 16:00, 18:00, 20:00) y un resumen a las 21:00.\n"
@@ -458,17 +553,21 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def pregunta_ahora(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    class DummyJob:
-        def __init__(self, chat_id): self.chat_id = chat_id
-    context.job = DummyJob(update.effective_chat.id)
-    await trivia_job(context)
+    ch = update.effective_chat
+    # Cuenta para ranking y medallas: en grupos solo la lanzan los administradores.
+    if ch.type in ("group","supergroup"):
+        member = await context.bot.get_chat_member(ch.id, update.effective_user.id)
+        if member.status not in ("administrator", "creator"):
+            await update.message.reply_text("Solo los administradores pueden lanzar preguntas de prueba.")
+            return
+    await send_round(context, [ch.id])
 
 async def ranking_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     kind = (context.args[0].lower() if context.args else "dia")
     if kind not in ("dia","semana","mes"):
         kind = "dia"
     chat_id = update.effective_chat.id
-    rows, roster, not_ans = fetch_rank(chat_id, kind)
+    rows, roster, not_ans = await asyncio.to_thread(fetch_rank, chat_id, kind)
     if not rows and not roster:
         await update.message.reply_text("Aún no hay datos para el ranking.")
         return
@@ -484,16 +583,39 @@ async def ranking_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lines.append(fmt_names(not_ans, limit=12))
     await update.message.reply_text("\n".join(lines))
 
-def main():
+def build_app():
     ensure_db()
-    persistence = PicklePersistence(filepath="bot_state.pkl")
-    app = ApplicationBuilder().token(TOKEN).persistence(persistence).build()
+    app = ApplicationBuilder().token(TOKEN).build()
+    # Los chats registrados viven en la tabla chats; bot_data es solo su espejo en memoria.
+    app.bot_data["chat_ids"] = load_chat_ids()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("ranking", ranking_cmd))
     app.add_handler(CommandHandler("pregunta_ahora", pregunta_ahora))
     app.add_handler(CallbackQueryHandler(answer_cb, pattern=r"^ans\|"))
     app.add_handler(MessageHandler(filters.ALL & (~filters.StatusUpdate.ALL), touch_user))
     app.add_handler(MessageHandler(filters.StatusUpdate.ALL, touch_user))
+    return app
+
+async def run_bot():
+    # Para ejecutarse dentro de un bucle ya existente (p. ej. el de uvicorn):
+    # run_polling() crea y gestiona su propio bucle, así que aquí se arranca a mano.
+    # build_app() abre y prepara la BD: fuera del bucle, como el resto de sqlite.
+    app = await asyncio.to_thread(build_app)
+    log.info("Arrancando bot…")
+    async with app:
+        await schedule_jobs(app)
+        try:
+            await app.updater.start_polling()
+            await app.start()
+            await asyncio.Event().wait()
+        finally:
+            if app.updater.running:
+                await app.updater.stop()
+            if app.running:
+                await app.stop()
+
+def main():
+    app = build_app()
     app.post_init = schedule_jobs
     log.info("Arrancando bot…")
     app.run_polling(close_loop=False)
@@ -1,32 +1,54 @@
-import os
-import threading
-from fastapi import FastAPI
-from uvicorn.main import Server, Config
-import subprocess
+import asyncio
+import logging
+from fastapi import FastAPI, Response
+
+from bot import run_bot
 
 app = FastAPI(title="GUN4FUN Keepalive")
+log = logging.getLogger("GUN4FUN-LG-TRIVIA")
 
-bot_proc = None
+bot_task = None
 
-def start_bot():
-    # Lanza el bot en un proceso hijo separado
-    # TOKEN y TZ vienen de variables de entorno
-    subprocess.Popen(["python", "bot.py"])
+def _on_bot_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        log.error("El bot se ha detenido con error", exc_info=task.exception())
 
 @app.on_event("startup")
 async def startup():
-    # Arranca el bot en hilo aparte para no bloquear FastAPI
-    t = threading.Thread(target=start_bot, daemon=True)
-    t.start()
+    # El bot corre en el mismo proceso, como tarea del bucle de uvicorn
+    # TOKEN y TZ vienen de variables de entorno
+    global bot_task
+    bot_task = asyncio.create_task(run_bot())
+    bot_task.add_done_callback(_on_bot_done)
+
+@app.on_event("shutdown")
+async def shutdown():
+    if bot_task and not bot_task.done():
+        bot_task.cancel()
+        try:
+            await bot_task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            log.exception("Error al detener el bot")
 
 @app.get("/")
 def root():
     return {"ok": True, "service": "gun4fun-trivia", "status": "alive"}
 
+def bot_alive() -> bool:
+    return bot_task is not None and not bot_task.done()
+
 @app.get("/health")
-def health_get():
+def health_get(response: Response):
+    # Si la tarea del bot ha terminado, Render debe ver el servicio como caído.
+    if not bot_alive():
+        response.status_code = 503
+        return {"status": "unhealthy", "bot": "stopped"}
     return {"status": "healthy"}
 
 @app.head("/health")
-def health_head():
+def health_head(response: Response):
+    if not bot_alive():
+        response.status_code = 503
     return {}